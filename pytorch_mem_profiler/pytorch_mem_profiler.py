@@ -1,11 +1,76 @@
 import torch
 from datetime import datetime
+import atexit
+import collections
+import functools
 import os
+import queue
+import sys
+import threading
+import weakref
 
 OUTPUT_DIR="./memory_csv_data/"
+CSV_BUFFER_SIZE=1<<16
+CSV_QUEUE_SIZE=16
+MAX_TRACKED_POINTERS=100000
+
+# Newer versions of PyTorch expose a tensor's untyped storage directly,
+# which avoids constructing a typed storage wrapper on every access
+HAS_UNTYPED_STORAGE=hasattr(torch.Tensor,"untyped_storage")
+# torch.cuda.memory_stats() was added in PyTorch 1.4
+HAS_MEMORY_STATS=hasattr(torch.cuda,"memory_stats")
+
+# Row templates of the table printed by memory_profiler
+TOTAL_ROW='{:.<45s}{:.>5d} MB'
+LAYER_PREFIX='  {:.<43s}'
+SIZE_COLUMN='{:.>5d} MB'
+LAYER_ROW=LAYER_PREFIX+SIZE_COLUMN
+
+class bounded_pointer_set(collections.OrderedDict):
+    """
+    A set of data pointers which holds at most MAX_TRACKED_POINTERS
+    entries, so the profiler's own memory stays bounded during long
+    epochs. Once full, adding a pointer evicts the least recently
+    seen one. An evicted pointer which shows up again is counted
+    again, so the reported totals can be overcounted once more than
+    MAX_TRACKED_POINTERS distinct pointers are seen in one epoch.
+    """
+    __slots__=()
+
+    def touch_or_add(self, dp):
+        """
+        Marks dp as the most recently seen pointer, adding it if it is
+        not in the set yet. Returns True if dp was not in the set.
+        """
+        if dp in self:
+            self.move_to_end(dp)
+            return False
+        self[dp]=None
+        if len(self)>MAX_TRACKED_POINTERS:
+            self.popitem(last=False)
+        return True
+
 
 class memory_profiler:
-    def __init__(self,model,print_period=1,csv=False):
+    # The hooks read and update these attributes hundreds of times per
+    # iteration, and slots are faster to access than an instance
+    # __dict__. As a consequence, no other attributes can be set on a
+    # memory_profiler instance.
+    __slots__=(
+        "csv","fname","csv_file","csv_queue",
+        "model",
+        "activation_data_pointers","memory_used_by_feature_maps",
+        "gradient_data_pointers","memory_used_by_gradients",
+        "unnamed_gradient_mem",
+        "print_period","iteration","epoch",
+        "__enabled","low_overhead","sampling",
+        "param_index","param_tensors","param_names",
+        "param_grad_sizes",
+        "param_rows","param_grad_prefixes","csv_row_template",
+        "total_weight_bytes","named_grad_bytes",
+    )
+
+    def __init__(self,model,print_period=1,csv=False,low_overhead=False):
         """
         Arguments:
             model : torch.nn.Module
@@ -20,6 +85,12 @@ class memory_profiler:
                 Indicates whether to report memory diagnostics to 
                 a .csv file. Filenames are uniquified by datetime,
                 and all values are in MB by default.        
+
+            low_overhead : Boolean
+                Indicates whether the hooks should only record memory
+                usage during the iterations which are reported, i.e.
+                every print_period-th iteration. The hooks return
+                immediately during all other iterations.
         """
         
         if print_period<1:
@@ -29,9 +100,9 @@ class memory_profiler:
         self.csv=csv # boolean for csv outputting
 
         self.model=model
-        self.activation_data_pointers=set()
+        self.activation_data_pointers=bounded_pointer_set()
         self.memory_used_by_feature_maps=0
-        self.gradient_data_pointers=set()
+        self.gradient_data_pointers=bounded_pointer_set()
         self.memory_used_by_gradients=0
 
         # Print stats every period of iterations
@@ -39,138 +110,198 @@ class memory_profiler:
         self.iteration=0
         self.epoch=1
 
+        # The hooks only record while sampling is enabled
+        self.__enabled=True
+        self.low_overhead=low_overhead
+        self.__update_sampling()
+
         # Gather the named parameters of the model (i.e. layers)
         self.__gather_named_parameters()
 
-        # Register hooks for feature maps:
-        for name, layer in self.model._modules.items():
-            layer.register_forward_hook(self.__forward_hook)
-            # In case there are submodules, register them as well
-            self.__recursive_hooks(layer)
-
-        # Register hooks for gradients
-        self.model.register_backward_hook(self.__backward_hook)
-
-        # Initialize the output directory
-        if self.csv:
-            try:
-                if not os.path.exists(OUTPUT_DIR):
-                    os.mkdir(OUTPUT_DIR)
-            except OSError:
-                print(f"Creation of the output directory {OUTPUT_DIR} failed")
-
-            # .csv column labels
-            s="epoch,"
-            s+="iteration,"
-            s+="peak_cached,"
-            s+="current_cached,"
-            s+="total_feature_map_usage,"
-            s+="total_weight_usage,"
-            for dp in self.params:
-                s+=self.params[dp]["name"]+","                
-            s+="total_layer_weight_gradient_usage,"
-            for dp in self.params:
-                s+=self.params[dp]["name"] + "_grad,"
-            s+="intermediate_gradients\n"
-            self.fname=OUTPUT_DIR + str(datetime.now().strftime("%Y%m%d%H%M%S")) + ".csv"
-            with open(self.fname,"w") as file:
-                file.write(s)
-            print(f"Logging data in {self.fname}")
+        # Register hooks for feature maps on every leaf submodule. The
+        # inputs and outputs of a container module are also the inputs
+        # and outputs of its children, so hooking containers as well
+        # would only inspect the same activations again
+        for layer in self.model.modules():
+            if layer is not self.model and next(layer.children(),None) is None:
+                layer.register_forward_hook(self.__forward_hook)
+
+        # Register hooks for gradients. Parameter gradients are hooked in
+        # __gather_named_parameters(), and the gradient of the model's
+        # output is hooked on the output tensor during every forward pass.
+        # Unlike a module backward hook on the model, this does not wrap
+        # the model's inputs and outputs in extra autograd nodes
+        self.model.register_forward_hook(self.__model_forward_hook)
+
+        # The .csv file is only created once the first row is written,
+        # so a profiler which never reports does not touch the disk
+        self.csv_file=None
         
 
     def __gather_named_parameters(self):
         """
-        Gathers named_parameters from the model.
+        Gathers named_parameters from the model, and registers a
+        gradient hook on each of them so that their gradients are
+        accounted for exactly once, as soon as they are computed.
         """
         # TODO: look into recursively registering submodules
-        self.params={} # dp -> {"tensor","size","name","grad_size"}
+        # Parameters are stored column-wise; entry i of each list
+        # describes the same parameter
+        self.param_index={} # dp -> i
+        # Weak references to the actual tensors, so that the profiler
+        # does not keep alive parameters which the model has dropped
+        self.param_tensors=[]
+        self.param_names=[] # user-specified names
+        self.param_grad_sizes=[] # mem of gradients (.grad)
+        # Total mem of the weights, and running total of the list above
+        self.total_weight_bytes=0
+        self.named_grad_bytes=0
+        # Weight sizes never change, so their .csv columns and table
+        # rows are formatted once here rather than at every report
+        size_columns=[]
+        self.param_rows=[]
+        self.param_grad_prefixes=[] # table rows minus the size column
         for name,param in self.model.named_parameters():
             dp=getDataPtr(param)
-            self.params[dp]={}
-            self.params[dp]["tensor"]=param # The actual tensor
-            self.params[dp]["size"]=getTensorSize(param,scale="B")
-            self.params[dp]["name"]=name # user-specified name
-            self.params[dp]["grad_size"]=0 # mem of gradient (.grad)
+            if dp in self.param_index:
+                continue
+            i=len(self.param_names)
+            self.param_index[dp]=i
+            self.param_tensors.append(weakref.ref(param))
+            self.param_names.append(name)
+            size=getTensorSize(param)
+            self.total_weight_bytes+=size
+            self.param_grad_sizes.append(0)
+            size_columns.append(str(MB(size)))
+            self.param_rows.append(LAYER_ROW.format(name, MB(size)))
+            self.param_grad_prefixes.append(LAYER_PREFIX.format(name + " grad"))
+            if param.requires_grad:
+                param.register_hook(functools.partial(self.__grad_hook,i))
+
+        # Template of a .csv row with the weight columns already filled
+        # in; see __write_info_csv() for the order of the fields
+        columns=["{}"]*5
+        columns.append(str(self.__total_layer_mem_MB()))
+        columns.extend(size_columns)
+        columns.append("{}")
+        columns.extend(["{}"]*len(self.param_names))
+        columns.append("{}")
+        self.csv_row_template=",".join(columns)+"\n"
 
 
     def __total_layer_mem_MB(self):
         """
-        Calculates the total memory usage of all the named 
-        parameters in self.params (weights)
+        Returns the total memory usage of all the named 
+        parameters (weights), as summed up in self.total_weight_bytes
         """
-        r=0
-        for dp in self.params:
-            r+=self.params[dp]["size"]
-        return MB(r)
+        return MB(self.total_weight_bytes)
 
 
-    def __recursive_hooks(self, layer):
-        '''
-        Recursively register forward hooks in all submodules
-        of the model. This ensures every activation is accounted
-        for during the forward pass.
-        '''
-        for name, layer in layer._modules.items():
-            layer.register_forward_hook(self.__forward_hook)
-            self.__recursive_hooks(layer)
+    def __update_sampling(self):
+        """
+        Enables the hooks for the upcoming iteration if the profiler
+        is enabled, and either the iteration is going to be reported
+        or low_overhead mode is off. The hooks only need to check the
+        resulting self.sampling flag.
+        """
+        self.sampling=self.__enabled and (
+            not self.low_overhead or (self.iteration+1) % self.print_period == 0)
 
 
     def __forward_hook(self,m, i, o):
         '''
-        The hook function to be registered on each module
+        The hook function to be registered on each leaf submodule
 
         Arguments:
             m : torch.nn.Module
             i : tuple of input activation tensors
             o : output activation tensor
         '''
-        if getDataPtr(o) not in self.activation_data_pointers:
-            self.activation_data_pointers.add(getDataPtr(o))
-            self.memory_used_by_feature_maps+=getTensorSize(o,scale="B")
+        if not self.sampling:
+            return
+
+        # Hoist the hot attributes into locals and write back once
+        seen=self.activation_data_pointers
+        used=self.memory_used_by_feature_maps
+
+        dp,size=getStorageStats(o)
+        if seen.touch_or_add(dp):
+            used+=size
         
         for input_t in i:
-            if getDataPtr(input_t) not in self.activation_data_pointers:
-                self.activation_data_pointers.add(getDataPtr(input_t))
-                self.memory_used_by_feature_maps+=getTensorSize(input_t,scale="B")
+            dp,size=getStorageStats(input_t)
+            if seen.touch_or_add(dp):
+                used+=size
+
+        self.memory_used_by_feature_maps=used
 
 
-    def __backward_hook(self, m, in_grads, out_grads):
+    def __grad_hook(self, i, grad):
         """
-        Registers hooks for the backward pass. By calling this as:
-            model.register_backward_hook(self.__backward_hook)
-        all intermediate gradients are registered as well, and not just
-        the gradients of leaf nodes in the computational graph.
-        https://discuss.pytorch.org/t/using-hook-function-to-save-gradients/4334
+        The hook function to be registered on each named parameter.
+        It fires once per backward pass with the gradient of that
+        parameter, which replaces scanning every parameter's .grad
+        each time a module's backward hook fires.
+
+        Arguments:
+            i : index of the parameter in the self.param_* lists
+            grad : gradient tensor of the parameter
+        """
+        if not self.sampling:
+            return
+
+        # Once .grad exists, new gradients are accumulated into it and
+        # the incoming tensor is only a temporary
+        param=self.param_tensors[i]()
+        if param is not None and param.grad is not None:
+            grad=param.grad
+
+        grad_dp,size=getStorageStats(grad)
+        if self.gradient_data_pointers.touch_or_add(grad_dp):
+            self.memory_used_by_gradients+=size
+            self.param_grad_sizes[i]+=size
+            self.named_grad_bytes+=size
+
+
+    def __model_forward_hook(self, m, i, o):
+        '''
+        The hook function registered on the model itself. It registers
+        __output_grad_hook on the output of the model, so that the
+        gradient of the output is accounted for during the following
+        backward pass.
+
+        Arguments:
+            m : torch.nn.Module
+            i : tuple of input tensors of the model
+            o : output tensor (or tuple of tensors) of the model
+        '''
+        if not self.sampling:
+            return
+
+        outputs=o if isinstance(o,(tuple,list)) else (o,)
+        for t in outputs:
+            if isinstance(t,torch.Tensor) and t.requires_grad:
+                t.register_hook(self.__output_grad_hook)
+
+
+    def __output_grad_hook(self, grad):
+        """
+        The hook function registered on each output of the model. It
+        fires once per backward pass with the gradient of that output.
 
         Intermediate gradient tensors are accumulated in C++ buffers, 
         and are only exposed to Python by using hooks.
         https://discuss.pytorch.org/t/how-the-hook-works/2222
 
-        Parameters:
-            m : torch.nn.Module
-            in_grads: input gradients
-            out_grads: output gradients
-
+        Arguments:
+            grad : gradient tensor of the model output
         """
-        # First, inspect the .grad of each module parameter
-        for dp in self.params:
-            t=self.params[dp]['tensor']
-            if t.grad is not None and getDataPtr(t.grad) not in self.gradient_data_pointers:
-                self.gradient_data_pointers.add(getDataPtr(t.grad))
-                self.memory_used_by_gradients+=getTensorSize(t.grad,scale="B")
-                self.params[dp]["grad_size"]+=getTensorSize(t.grad,scale="B")
-
-        # Inspect the input grads to this submodule
-        for t in in_grads:
-            if getDataPtr(t) not in self.gradient_data_pointers:
-                self.gradient_data_pointers.add(getDataPtr(t))
-                self.memory_used_by_gradients+=getTensorSize(t,scale="B")
-
-        # Inspect the output grads to this submodule
-        for t in out_grads:
-            if getDataPtr(t) not in self.gradient_data_pointers:
-                self.gradient_data_pointers.add(getDataPtr(t))
-                self.memory_used_by_gradients+=getTensorSize(t,scale="B")
+        if not self.sampling:
+            return
+
+        dp,size=getStorageStats(grad)
+        if self.gradient_data_pointers.touch_or_add(dp):
+            self.memory_used_by_gradients+=size
         
 
     def record_stats(self):
@@ -181,20 +312,21 @@ class memory_profiler:
         memory statistics to a .csv file.
 
         Note: 
-        torch.cuda.max_memory_cached() and 
-        torch.cuda.memory_cached() are deprecated in later versions,
-        replaced by torch.cuda.max_memory_reserved() and 
-        torch.cuda.memory_reserved().
+        The cache sizes are queried once per report with
+        getCachedMemory() and shared by the table and the .csv file.
         """
         self.iteration+=1
         
         if self.iteration % self.print_period == 0:
-            self.__print_info_table()
+            peak_cached,current_cached=getCachedMemory()
+            self.__print_info_table(peak_cached,current_cached)
             if self.csv:
-                self.__write_info_csv()
+                self.__write_info_csv(peak_cached,current_cached)
+
+        self.__update_sampling()
    
     
-    def __print_info_table(self):
+    def __print_info_table(self,peak_cached,current_cached):
         """
         Prints memory diagnostics about weights, gradients, and 
         activations in a user-friendly table. 
@@ -212,76 +344,130 @@ class memory_profiler:
         memory (on the order of a few hundred MB) which is not 
         attributable to any relevant parts of the model.
 
-        Note: 
-        torch.cuda.max_memory_cached() and 
-        torch.cuda.memory_cached() are deprecated in later versions,
-        replaced by torch.cuda.max_memory_reserved() and 
-        torch.cuda.memory_reserved().
+        Arguments:
+            peak_cached : peak size of the CUDA memory cache in bytes
+            current_cached : current size of the CUDA memory cache in bytes
         """
         dash = '*' * 43
-        print("\n"+dash)
-        print("Memory Usage for Iteration", self.iteration, "of Epoch", self.epoch)
-        print(dash)
-
-        #print('{:.<35s}{:.>5d} MB'.format("Peak allocated", MB(torch.cuda.max_memory_allocated())))
-        #print('{:.<35s}{:.>5d} MB'.format("Current allocated", MB(torch.cuda.memory_allocated())))
-        print('{:.<45s}{:.>5d} MB'.format("Peak cached", MB(torch.cuda.max_memory_cached())))
-        print('{:.<45s}{:.>5d} MB'.format("Current cached", MB(torch.cuda.memory_cached())))
-        print('{:.<45s}{:.>5d} MB'.format("Total feature map usage", MB(self.memory_used_by_feature_maps)))
+        lines=["",dash]
+        lines.append(f"Memory Usage for Iteration {self.iteration} of Epoch {self.epoch}")
+        lines.append(dash)
+
+        #lines.append(TOTAL_ROW.format("Peak allocated", MB(torch.cuda.max_memory_allocated())))
+        #lines.append(TOTAL_ROW.format("Current allocated", MB(torch.cuda.memory_allocated())))
+        lines.append(TOTAL_ROW.format("Peak cached", MB(peak_cached)))
+        lines.append(TOTAL_ROW.format("Current cached", MB(current_cached)))
+        lines.append(TOTAL_ROW.format("Total feature map usage", MB(self.memory_used_by_feature_maps)))
         
         # Layer-by-layer weight breakdown
-        print('\n{:.<45s}{:.>5d} MB'.format("Total layer weight usage", self.__total_layer_mem_MB()))
-        for dp in self.params:
-            print('{:<2s}{:.<43s}{:.>5d} MB'.format('',self.params[dp]["name"], MB(self.params[dp]["size"])))
+        lines.append("")
+        lines.append(TOTAL_ROW.format("Total layer weight usage", self.__total_layer_mem_MB()))
+        lines.extend(self.param_rows)
 
         # Total of layer gradients
-        total_layer_grad=0
-        for dp in self.params:
-            total_layer_grad+=self.params[dp]["grad_size"]
-        print('\n{:.<45s}{:.>5d} MB'.format("Total layer weight gradient usage", MB(total_layer_grad)))
+        lines.append("")
+        lines.append(TOTAL_ROW.format("Total layer weight gradient usage", MB(self.named_grad_bytes)))
 
         # Layer-by-layer gradient breakdown
-        self.unnamed_gradient_mem=self.memory_used_by_gradients
-        for dp in self.params:
-            print('{:<2s}{:.<43s}{:.>5d} MB'.format('',self.params[dp]["name"] + " grad", MB(self.params[dp]["grad_size"])))
-            self.unnamed_gradient_mem-=self.params[dp]["grad_size"]
+        for prefix,grad_size in zip(self.param_grad_prefixes,self.param_grad_sizes):
+            lines.append(prefix + SIZE_COLUMN.format(MB(grad_size)))
 
         # Other gradients that are not attributable to specific named layers
-        print('{:.<45s}{:.>5d} MB'.format("Intermediate gradients", MB(self.unnamed_gradient_mem)))
+        self.unnamed_gradient_mem=self.memory_used_by_gradients-self.named_grad_bytes
+
+        lines.append(TOTAL_ROW.format("Intermediate gradients", MB(self.unnamed_gradient_mem)))
+
+        # Emit the whole table with a single write
+        sys.stdout.write("\n".join(lines)+"\n")
     
 
-    def __write_info_csv(self):
+    def __open_csv(self):
+        """
+        Creates the output directory and the .csv file, and writes
+        the column labels.
         """
-        Prints memory diagnostics info to a .csv file. 
-        Functionally, this information is identical to
-        __print_info_table().
+        try:
+            os.makedirs(OUTPUT_DIR,exist_ok=True)
+        except OSError:
+            print(f"Creation of the output directory {OUTPUT_DIR} failed")
+
+        # .csv column labels
+        labels=["epoch","iteration","peak_cached","current_cached",
+                "total_feature_map_usage","total_weight_usage"]
+        labels.extend(self.param_names)
+        labels.append("total_layer_weight_gradient_usage")
+        labels.extend(name + "_grad" for name in self.param_names)
+        labels.append("intermediate_gradients")
+        self.fname=OUTPUT_DIR + str(datetime.now().strftime("%Y%m%d%H%M%S")) + ".csv"
+        # The file is kept open for the whole run rather than being
+        # reopened for every row. Rows are buffered and flushed at the
+        # end of every epoch (and when the file is closed at exit)
+        self.csv_file=open(self.fname,"w",buffering=CSV_BUFFER_SIZE)
+        self.csv_file.write(",".join(labels)+"\n")
+        print(f"Logging data in {self.fname}")
+
+        # Rows are written by a background thread, so that the training
+        # loop never waits on the file
+        self.csv_queue=queue.Queue(maxsize=CSV_QUEUE_SIZE)
+        threading.Thread(target=self.__csv_worker,daemon=True).start()
+        atexit.register(self.__close_csv)
+
+
+    def __csv_worker(self):
+        """
+        Writes the rows put in self.csv_queue to the .csv file. Runs
+        in a daemon thread for the lifetime of the program.
+        """
+        while True:
+            row=self.csv_queue.get()
+            try:
+                self.csv_file.write(row)
+            except (OSError,ValueError) as e:
+                # ValueError is raised when writing to a closed file
+                print(f"Writing to {self.fname} failed: {e}")
+            finally:
+                # Always mark the row as done, otherwise epoch_end() and
+                # __close_csv() would wait on the queue forever
+                self.csv_queue.task_done()
+
+
+    def __close_csv(self):
+        """
+        Waits for the queued rows to be written, then closes the
+        .csv file. Registered to run when the program exits.
+        """
+        self.csv_queue.join()
+        self.csv_file.close()
+
+
+    def __write_info_csv(self,peak_cached,current_cached):
+        """
+        Formats memory diagnostics info as a .csv row and queues it
+        for the background writer thread. Functionally, this
+        information is identical to __print_info_table().
+
+        The row is not in the file yet when this returns; queued rows
+        only reach the disk when epoch_end() flushes the file, or when
+        the file is closed at exit.
 
         All values are in MB.
 
-        Note: 
-        torch.cuda.max_memory_cached() and 
-        torch.cuda.memory_cached() are deprecated in later versions,
-        replaced by torch.cuda.max_memory_reserved() and 
-        torch.cuda.memory_reserved().
+        Arguments:
+            peak_cached : peak size of the CUDA memory cache in bytes
+            current_cached : current size of the CUDA memory cache in bytes
         """
-        s=str(self.epoch) + ","
-        s+=str(self.iteration) + ","
-        #s+=str(MB(torch.cuda.max_memory_allocated()))+","
-        s+=str(MB(torch.cuda.max_memory_cached()))+","
-        s+=str(MB(torch.cuda.memory_cached()))+","
-        s+=str(MB(self.memory_used_by_feature_maps))+","
-        s+=str(self.__total_layer_mem_MB())+","
-        for dp in self.params:
-            s+=str(MB(self.params[dp]["size"]))+","
-        total_layer_grad=0
-        for dp in self.params:
-            total_layer_grad+=self.params[dp]["grad_size"]
-        s+=str(MB(total_layer_grad))+","
-        for dp in self.params:
-            s+=str(MB(self.params[dp]["grad_size"]))+","
-        s+=str(MB(self.unnamed_gradient_mem))+"\n"
-        with open(self.fname,"a") as file:
-            file.write(s)
+        row=self.csv_row_template.format(
+            self.epoch,self.iteration,
+            #MB(torch.cuda.max_memory_allocated()),
+            MB(peak_cached),MB(current_cached),
+            MB(self.memory_used_by_feature_maps),
+            # total and per-layer weight usage are part of the template
+            MB(self.named_grad_bytes),
+            *[MB(grad_size) for grad_size in self.param_grad_sizes],
+            MB(self.unnamed_gradient_mem))
+        if self.csv_file is None:
+            self.__open_csv()
+        self.csv_queue.put(row)
             
     
     def epoch_end(self):
@@ -289,14 +475,48 @@ class memory_profiler:
         To be called by the user after each epoch is finished.
         '''
         print(f"Epoch {self.epoch} finished")
-        self.activation_data_pointers=set()
+        if self.csv_file is not None:
+            self.csv_queue.join()
+            self.csv_file.flush()
+        self.activation_data_pointers=bounded_pointer_set()
         self.memory_used_by_feature_maps=0
-        self.gradient_data_pointers=set()
+        self.gradient_data_pointers=bounded_pointer_set()
         self.memory_used_by_gradients=0
         self.iteration=0
         self.epoch+=1
-        for dp in self.params:
-            self.params[dp]["grad_size"]=0
+        self.__update_sampling()
+        self.param_grad_sizes=[0]*len(self.param_names)
+        self.named_grad_bytes=0
+
+
+    @property
+    def enabled(self):
+        '''
+        Whether the profiler is recording memory usage. Read-only:
+        use enable() and disable() to change it, so that the hooks
+        see the change immediately.
+        '''
+        return self.__enabled
+
+
+    def enable(self):
+        '''
+        Resumes recording memory usage in the hooks, starting with the
+        next forward pass. Profilers are enabled when created.
+        '''
+        self.__enabled=True
+        self.__update_sampling()
+
+
+    def disable(self):
+        '''
+        Stops recording memory usage in the hooks until enable() is
+        called, so that the profiler adds almost no overhead to the
+        iterations in between. Reports are still printed, but only
+        include the memory recorded while the profiler was enabled.
+        '''
+        self.__enabled=False
+        self.__update_sampling()
 
 
 def getDataPtr(tensor):
@@ -307,26 +527,58 @@ def getDataPtr(tensor):
     counting memory management system would not free tensors when
     the model is no longer using them.
     """
+    if HAS_UNTYPED_STORAGE:
+        return tensor.untyped_storage().data_ptr()
     return tensor.storage().data_ptr()
 
 
-def getTensorSize(tensor, scale="MB"):
+def getTensorSize(tensor):
     """
-    Get the size of a tensor
+    Get the size of a tensor in bytes. Sizes are kept in bytes
+    everywhere and only converted with MB() when they are reported.
     """
+    if HAS_UNTYPED_STORAGE:
+        return tensor.untyped_storage().nbytes()
     element_size = tensor.element_size()
     numel = tensor.storage().size()
-    memory_size = numel * element_size
-    if scale=="MB":
-        return MB(memory_size)
-    if scale=="B":
-        return memory_size
-    print(f"ERROR: unknown scale in getTensorSize: {scale}")
-    exit()
+    return numel * element_size
+
+
+def getStorageStats(tensor):
+    """
+    Get the data pointer and size in bytes of a tensor's storage.
+    Both are read off a single storage object, so the hooks only pay
+    for one storage lookup per tensor instead of one in getDataPtr()
+    and another in getTensorSize().
+    """
+    if HAS_UNTYPED_STORAGE:
+        storage=tensor.untyped_storage()
+        return storage.data_ptr(), storage.nbytes()
+    storage=tensor.storage()
+    return storage.data_ptr(), storage.size()*storage.element_size()
+
+
+def getCachedMemory():
+    """
+    Get the peak and current size in bytes of the CUDA memory cache.
+
+    Both are read from a single torch.cuda.memory_stats() snapshot of
+    the caching allocator. It reports the same values as
+    torch.cuda.max_memory_reserved() and torch.cuda.memory_reserved(),
+    which replace the deprecated torch.cuda.max_memory_cached() and
+    torch.cuda.memory_cached(). The deprecated functions are only used
+    on versions of PyTorch which do not have memory_stats().
+    """
+    if HAS_MEMORY_STATS:
+        stats=torch.cuda.memory_stats()
+        # The snapshot is empty until CUDA has been initialized
+        return stats.get("reserved_bytes.all.peak",0), stats.get("reserved_bytes.all.current",0)
+    return torch.cuda.max_memory_cached(), torch.cuda.memory_cached()
 
 
 def MB(B):
     """
-    Convert B bytes to the nearest megabyte.
+    Convert B bytes to whole megabytes, using 1 MB = 1024*1024 bytes
+    like the sizes reported by CUDA. B must be an integer.
     """
-    return round(float(B)/1000000.0)
\ No newline at end of file
+    return B >> 20
\ No newline at end of file